@@ -1,34 +1,148 @@
+import asyncio
+import base64
 import json
 import subprocess
 import logging
 import boto3
+import orjson
+from boto3.s3.transfer import TransferConfig
 import os
 import os.path
+import random
 import urllib.parse
 import re
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
 from typing import Union
 
+from cachetools import TTLCache
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
 from dotenv import load_dotenv
-from fastapi import FastAPI, requests
+from fastapi import FastAPI, Request, Response, requests
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError, EndpointConnectionError
 from botocore.credentials import InstanceMetadataProvider, InstanceMetadataFetcher
 import  requests
 # Load environment variables from .env file
 #load_dotenv()
 
+# Background tasks that live as long as the app
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    job_poller = asyncio.create_task(poll_transcription_jobs())
+    yield
+    job_poller.cancel()
+
 # Creating the app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Setting up the logging
-logging.basicConfig(level = logging.INFO)
+logging.basicConfig(level = os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 # AWS setup
 aws_region = "us-west-2"
 logger.info(aws_region)
-s3_client = boto3.client("s3", region_name = aws_region)
-transcribe_client = boto3.client("transcribe", region_name = aws_region)
+# Shared client config: a pool large enough for concurrent requests and
+# multipart uploads, adaptive retries, and TCP keepalive on pooled connections
+boto_config = Config(
+    region_name=aws_region,
+    max_pool_connections=50,
+    retries={"max_attempts": 8, "mode": "adaptive"},
+    tcp_keepalive=True
+)
+s3_client = boto3.client("s3", config = boto_config)
+transcribe_client = boto3.client("transcribe", config = boto_config)
+sqs_client = boto3.client("sqs", config = boto_config)
+sns_client = boto3.client("sns", config = boto_config)
+
+# When EXTRACT_QUEUE_URL is set, /extract-audio only enqueues the job and worker.py
+# runs it, publishing the result to EXTRACT_COMPLETION_TOPIC_ARN
+EXTRACT_QUEUE_URL = os.environ.get("EXTRACT_QUEUE_URL")
+EXTRACT_COMPLETION_TOPIC_ARN = os.environ.get("EXTRACT_COMPLETION_TOPIC_ARN")
+
+# S3 transfer tuning: 8 MiB parts uploaded concurrently
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True
+)
+
+# Asset file names are <GUID>.mp4 / <GUID>.mp3
+ASSET_MP4_RE = re.compile(r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\.mp4$', re.I)
+ASSET_MP3_RE = re.compile(r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\.mp3$', re.I)
+# The common case, https://<bucket>.s3.<region>.amazonaws.com/<prefix>/<GUID>.mp4, in one pass
+S3_ASSET_URL_RE = re.compile(
+    r'^https?://(?P<bucket>[^./]+)\.s3\.' + re.escape(aws_region) + r'\.amazonaws\.com/'
+    r'(?P<key>(?:[^?#]*/)?(?P<asset>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\.mp4)$',
+    re.I
+)
+
+# S3 error codes that mean the bucket or object is missing
+MISSING_S3_ERROR_CODES = ("NoSuchBucket", "NoSuchKey", "404")
+# AWS error codes that are worth retrying once botocore's own retries run out
+RETRYABLE_ERROR_CODES = (
+    "Throttling", "ThrottlingException", "TooManyRequestsException", "LimitExceededException",
+    "SlowDown", "RequestTimeout", "InternalFailure", "InternalServerError", "ServiceUnavailable"
+)
+
+# Successful probe results, keyed by URL or by (bucket, key, ETag) for S3 objects
+PROBE_CACHE = TTLCache(maxsize=10_000, ttl=3600)
+
+# Local copies of S3 source videos, named by ETag, so repeat probes and
+# extractions read from disk. LOCAL_CACHE_MAX_BYTES=0 turns the cache off.
+LOCAL_CACHE_DIR = os.environ.get("LOCAL_CACHE_DIR", "/var/cache/media")
+LOCAL_CACHE_MAX_BYTES = int(os.environ.get("LOCAL_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+# Per-file download locks as [lock, number of requests using it]
+LOCAL_CACHE_LOCKS = {}
+# Copies handed out to a running ffmpeg/ffprobe, which eviction must skip. The
+# threading lock is held only around the in-use check and the stat/unlink it
+# guards, so eviction (on a worker thread) can't race a hand-out.
+LOCAL_CACHE_IN_USE = {}
+LOCAL_CACHE_IN_USE_LOCK = threading.Lock()
+# Downloads in progress as {.part path: final size}, counted against the cap
+# before they land. Also guarded by LOCAL_CACHE_IN_USE_LOCK.
+LOCAL_CACHE_DOWNLOADS = {}
+# Unregistered .part files untouched for this long were left by a crashed download
+STALE_PART_THRESHOLD = 3600
+
+# Each ffmpeg encode gets FFMPEG_THREADS threads, and at most enough encodes
+# run at once to fill the cores; the rest wait on the event loop
+FFMPEG_THREADS = 2
+FFMPEG_CONCURRENCY = int(os.environ.get("FFMPEG_CONCURRENCY", max(1, (os.cpu_count() or 1) // FFMPEG_THREADS)))
+FFMPEG_SEMAPHORE = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+
+# In-flight start_transcription_job calls are capped at the connection pool size
+# so a burst of submissions never queues on it
+TRANSCRIPTION_SUBMIT_SEMAPHORE = asyncio.Semaphore(boto_config.max_pool_connections)
+
+# Jobs started by this process and their last known status. Completion normally
+# arrives through /transcribe-callback; a slow sweep catches dropped notifications.
+TRANSCRIPTION_JOBS = TTLCache(maxsize=10_000, ttl=24 * 3600)
+TERMINAL_JOB_STATUSES = ("COMPLETED", "FAILED")
+POLLING_INTERVAL = 300
+STALE_JOB_THRESHOLD = 7200
+# Longest a /transcribe-wait request may hold its connection open, in seconds
+MAX_WAIT_TIMEOUT = 900
+
+# /transcribe-callback only accepts correctly signed messages from this SNS topic
+TRANSCRIBE_CALLBACK_TOPIC_ARN = os.environ.get("TRANSCRIBE_CALLBACK_TOPIC_ARN")
+SNS_SIGNING_CERT_HOST_RE = re.compile(r'^sns\.[a-z0-9-]+\.amazonaws\.com$')
+SNS_SIGNING_CERTS = TTLCache(maxsize=16, ttl=24 * 3600)
+# Fields covered by the signature, in signing order, per message type
+SNS_SIGNED_FIELDS = {
+    "Notification": ("Message", "MessageId", "Subject", "Timestamp", "TopicArn", "Type"),
+    "SubscriptionConfirmation": ("Message", "MessageId", "SubscribeURL", "Timestamp", "Token", "TopicArn", "Type"),
+    "UnsubscribeConfirmation": ("Message", "MessageId", "SubscribeURL", "Timestamp", "Token", "TopicArn", "Type"),
+}
 
 # Models
 class ProbeRequest(BaseModel):
@@ -42,9 +156,12 @@ class ProbeResponse(BaseModel):
 
 class ExtractAudioRequest(BaseModel):
     url:str
+    transcribe_directly: bool = False  # Send the S3-hosted MP4 straight to Transcribe
+    language_code: str = "en-US"  # For whichever transcription job gets started, see extract_audio
 
 class ExtractAudioResponse(BaseModel):
     success : bool
+    job_id: Union[str, None] = None  # Set when the job was queued for a worker
     output_key: Union[str,None] = None
     transcription_job_name: Union[str, None] = None
     error: Union[str, None] = None
@@ -58,6 +175,16 @@ class TranscribeAudioResponse(BaseModel):
     success: bool
     transcription_job_name: Union[str, None] = None
     error: Union[str, None] = None
+class TranscriptionStatusResponse(BaseModel):
+    success: bool
+    transcription_job_name: Union[str, None] = None
+    status: Union[str, None] = None
+    transcript_uri: Union[str, None] = None
+    error: Union[str, None] = None
+
+class TranscribeCallbackResponse(BaseModel):
+    success: bool
+    error: Union[str, None] = None
 # Endpoints
 @app.get("/")
 def read_root():
@@ -66,154 +193,198 @@ def read_root():
 @app.post("/probe-audio", response_model = ProbeResponse)
 async def probe_audio(req: ProbeRequest) -> ProbeResponse:
     logger.info("Detecting if the audio stream is there")
+    local_copy = None
     try:
+        cache_key = await probe_cache_key(req.url)
+        cached = PROBE_CACHE.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            logger.debug("Probe cache hit for %s", req.url)
+            return cached
+
+        # Probing only reads headers, so use a local copy if one exists but never download
+        if isinstance(cache_key, tuple):
+            local_copy = acquire_local_copy(cache_key[2])
+        source = local_copy or req.url
+
         command = [
             "ffprobe",
+            "-hide_banner",
             "-v", "error",
-            "-print_format", "json",
-            "-show_format",
-            "-show_streams",
-            req.url
+            "-select_streams", "a",
+            "-show_entries", "stream=codec_type,duration:format=duration",
+            "-of", "json",
+            source
         ]
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        output = json.loads(result.stdout)
-
-        has_audio = any(stream.get("codec_type") == "audio" for stream in output.get("streams", []))
-        duration = None
-        # Prefer format duration, fallback to stream duration
-        if "format" in output and "duration" in output["format"]:
-            duration = float(output["format"]["duration"])
-        elif output.get("streams"):
-            for stream in output["streams"]:
-                if "duration" in stream:
-                    duration = float(stream["duration"])
-                    break
-        logger.info(f"Detected audio - {has_audio},duration - {duration}")
-        return ProbeResponse(success=True, has_audio=has_audio, duration=duration)
+        stdout = await run_command(command)
+        output = orjson.loads(stdout)
+
+        streams = output.get("streams") or ()
+        # Prefer format duration, fallback to the first stream that has one
+        duration = output.get("format", {}).get("duration")
+        if duration is None:
+            duration = next((stream["duration"] for stream in streams if "duration" in stream), None)
+        duration = float(duration) if duration is not None else None
+        # Only audio streams are selected, so this stops at the first stream
+        has_audio = any(stream.get("codec_type") == "audio" for stream in streams)
+        logger.info("Detected audio - %s,duration - %s", has_audio, duration)
+        response = ProbeResponse(success=True, has_audio=has_audio, duration=duration)
+        if cache_key is not None:
+            PROBE_CACHE[cache_key] = response
+        return response
 
     except subprocess.CalledProcessError as e:
-        logger.error(f"ffprobe failed - {e.stderr}")
+        logger.error("ffprobe failed - %s", e.stderr)
         return ProbeResponse(success=False, error=f"ffprobe failed - {e.stderr}")
 
+    except orjson.JSONDecodeError as e:
+        logger.error("ffprobe returned invalid JSON - %s", e)
+        return ProbeResponse(success=False, error=f"ffprobe returned invalid JSON - {str(e)}")
+
     except Exception as e:
-        logger.error(f"ffprobe failed - {str(e)}")
+        logger.error("ffprobe failed - %s", e)
         return ProbeResponse(success=False, error=str(e))
 
+    finally:
+        release_local_copy(local_copy)
+
 
 @app.post("/extract-audio", response_model=ExtractAudioResponse)
-async def extract_audio(req: ExtractAudioRequest) -> ExtractAudioResponse:
-    logger.info(f"Starting audio extraction for URL: {req.url}")
-    temp_audio_file = None
+async def extract_audio(req: ExtractAudioRequest, response: Response) -> ExtractAudioResponse:
+    """Extract an asset's audio to MP3, or hand the MP4 straight to Transcribe with transcribe_directly.
+
+    Inline (no EXTRACT_QUEUE_URL), the MP3 is only extracted and callers follow
+    up with /transcribe-audio. Queued, the worker runs the whole pipeline and
+    also starts the transcription job from the MP3, so calling /transcribe-audio
+    for the same asset afterwards fails with a ConflictException.
+    """
+    if not EXTRACT_QUEUE_URL:
+        return await run_extract_audio(req)
+
+    logger.info("Queueing audio extraction for URL: %s", req.url)
     try:
-        # Extract asset_id from URL (assuming file name is <asset_id>.mp4)
-        parsed_url = urllib.parse.urlparse(req.url)
-        file_name = os.path.basename(parsed_url.path)
-        # Validate file name format and extract asset_id
-        if not file_name.endswith('.mp4'):
-            raise ValueError(f"Input file must be an .mp4 file, got: {file_name}")
-        asset_id = re.match(r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\.mp4$', file_name, re.I)
-        if not asset_id:
-            raise ValueError(f"File name must be a GUID followed by .mp4, got: {file_name}")
-        asset_id = asset_id.group(1)  # Extract GUID
-        temp_audio_file = f"/tmp/{asset_id}.mp3"
+        # Reject bad URLs now rather than in the worker
+        parse_asset_url(req.url)
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(
+            sqs_client.send_message,
+            QueueUrl=EXTRACT_QUEUE_URL,
+            MessageBody=orjson.dumps({"job_id": job_id, "request": req.model_dump()}).decode()
+        )
+        response.status_code = 202
+        return ExtractAudioResponse(success=True, job_id=job_id)
+
+    except (ClientError, NoCredentialsError, EndpointConnectionError) as e:
+        logger.error("AWS SQS operation failed: %s", e)
+        return ExtractAudioResponse(success=False, error=f"AWS SQS error: {str(e)}")
+
+    except ValueError as e:
+        logger.error("Validation error: %s", e)
+        return ExtractAudioResponse(success=False, error=f"Validation error: {str(e)}")
+
+    except Exception as e:
+        logger.error("Unexpected error: %s", e)
+        return ExtractAudioResponse(success=False, error=f"Unexpected error: {str(e)}")
 
-        # Extract audio with ffmpeg
-        logger.info(f"Extracting audio to {temp_audio_file}")
+async def run_extract_audio(req: ExtractAudioRequest, queued=False) -> ExtractAudioResponse:
+    """Run an extraction and report any failure in the response.
+
+    Queued jobs can be redelivered, so with `queued` transient AWS errors are
+    raised instead (leaving the message for another attempt) and a
+    transcription job that already exists counts as started.
+    """
+    logger.info("Starting audio extraction for URL: %s", req.url)
+    local_copy = None
+    try:
+        bucket_name, video_key, asset_id = parse_asset_url(req.url)
+
+        # Transcribe reads MP4 itself, so skip the encode and MP3 upload entirely
+        if req.transcribe_directly:
+            try:
+                await asyncio.to_thread(s3_client.head_object, Bucket=bucket_name, Key=video_key)
+            except ClientError as e:
+                if e.response["Error"]["Code"] in MISSING_S3_ERROR_CODES:
+                    raise ValueError(f"Invalid or inaccessible video file: {video_key}")
+                raise
+            transcription_job_name = await start_asset_transcription(
+                asset_id, bucket_name, video_key, 'mp4', req.language_code, existing_ok=queued
+            )
+            return ExtractAudioResponse(success=True, transcription_job_name=transcription_job_name)
+
+        # Extract audio with ffmpeg, streaming the MP3 straight into S3
+        audio_key = audio_key_for(asset_id)
+        logger.info("Extracting audio to S3: %s/%s", bucket_name, audio_key)
+        local_copy = await acquire_s3_local_copy(bucket_name, video_key)
+        source = local_copy or req.url
         command = [
             "ffmpeg",
-            "-i", req.url,
+            "-nostdin",
+            "-hide_banner",
+            "-loglevel", "error",
+            "-fflags", "+nobuffer",
+            "-i", source,
             "-vn",
-            "-acodec", "mp3",
-            "-y",
-            temp_audio_file
+            # Speech-grade audio is all Transcribe needs: 16 kHz mono at 32 kbps
+            "-ac", "1",
+            "-ar", "16000",
+            "-c:a", "libmp3lame",
+            "-b:a", "32k",
+            "-threads", str(FFMPEG_THREADS),
+            "-f", "mp3",
+            "pipe:1"
         ]
-        subprocess.run(command, capture_output=True, text=True, check=True)
-
-        # Parse bucket name from URL
-        logger.info(f"parsed url - {parsed_url}")
-        bucket_name = None
-        if parsed_url.netloc.endswith(f'.s3.{aws_region}.amazonaws.com'):
-            bucket_name = parsed_url.netloc.split('.')[0]
-        elif parsed_url.scheme == 's3':
-            bucket_name = parsed_url.path.split('/')[1]
-        else:
-            raise ValueError("Could not determine bucket name from URL")
-
-        # Verify bucket exists
-        try:
-            s3_client.head_bucket(Bucket=bucket_name)
-        except ClientError as e:
-            logger.error(f"Bucket {bucket_name} does not exist or is inaccessible: {e}")
-            raise ValueError(f"Invalid or inaccessible bucket: {bucket_name}")
-
-        # Upload to S3
-        audio_key = f"VOD/FinishedVideos/{asset_id}.mp3"
-        logger.info(f"Uploading audio to S3: {bucket_name}/{audio_key}")
-        s3_client.upload_file(
-            temp_audio_file,
-            bucket_name,
-            audio_key,
-            ExtraArgs={'ContentType': 'audio/mpeg'}
-        )
+        async with FFMPEG_SEMAPHORE:
+            await stream_command_to_s3(command, bucket_name, audio_key, {'ContentType': 'audio/mpeg'})
 
         return ExtractAudioResponse(success=True, output_key=audio_key)
 
     except subprocess.CalledProcessError as e:
-        logger.error(f"ffmpeg failed: {e.stderr}")
+        logger.error("ffmpeg failed: %s", e.stderr)
         return ExtractAudioResponse(success=False, error=f"Audio extraction failed: {e.stderr}")
 
-    except (ClientError, NoCredentialsError, EndpointConnectionError) as e:
-        logger.error(f"AWS S3 operation failed: {str(e)}")
+    except ClientError as e:
+        if e.response["Error"]["Code"] in MISSING_S3_ERROR_CODES:
+            logger.error("Bucket %s does not exist or is inaccessible: %s", bucket_name, e)
+            return ExtractAudioResponse(success=False, error=f"Validation error: Invalid or inaccessible bucket: {bucket_name}")
+        if queued and is_retryable_error(e):
+            raise
+        logger.error("AWS S3 operation failed: %s", e)
+        return ExtractAudioResponse(success=False, error=f"AWS S3 error: {str(e)}")
+
+    except (NoCredentialsError, EndpointConnectionError) as e:
+        if queued:
+            raise
+        logger.error("AWS S3 operation failed: %s", e)
         return ExtractAudioResponse(success=False, error=f"AWS S3 error: {str(e)}")
 
     except ValueError as e:
-        logger.error(f"Validation error: {str(e)}")
+        logger.error("Validation error: %s", e)
         return ExtractAudioResponse(success=False, error=f"Validation error: {str(e)}")
 
     except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
+        logger.error("Unexpected error: %s", e)
         return ExtractAudioResponse(success=False, error=f"Unexpected error: {str(e)}")
 
     finally:
-        if os.path.exists(temp_audio_file):
-            try:
-                os.remove(temp_audio_file)
-                logger.info(f"Cleaned up temporary file: {temp_audio_file}")
-            except Exception as e:
-                logger.error(f"Failed to clean up temporary file: {str(e)}")
+        release_local_copy(local_copy)
 
 @app.post("/transcribe-audio", response_model=TranscribeAudioResponse)
 async def transcribe_audio(req: TranscribeAudioRequest) -> TranscribeAudioResponse:
-    logger.info(f"Starting transcription for S3 key: {req.audio_key}")
+    logger.info("Starting transcription for S3 key: %s", req.audio_key)
 
-    metadata = get_ecs_credential_metadata()
+    metadata = await asyncio.to_thread(get_ecs_credential_metadata)
     print(json.dumps(metadata, indent=2))
 
     try:
-        # Extract asset_id from audio_key (assuming format VOD/FinishedVideos/<asset_id>.mp3)
+        # Extract asset_id from audio_key (assuming format VOD/FinishedVideos/<xx>/<asset_id>.mp3)
         file_name = os.path.basename(req.audio_key)
-        asset_id = re.match(r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\.mp3$', file_name, re.I)
+        asset_id = ASSET_MP3_RE.match(file_name)
         if not asset_id:
             raise ValueError(f"Audio file name must be a GUID followed by .mp3, got: {file_name}")
         asset_id = asset_id.group(1)  # Extract GUID
-        transcription_job_name = f"transcription_{asset_id}"
-
-        # Verify audio file exists in S3
-        try:
-            s3_client.head_object(Bucket=req.bucket_name, Key=req.audio_key)
-        except ClientError as e:
-            logger.error(f"S3 object - {req.bucket_name}/{req.audio_key} does not exist or is inaccessible: {e}")
-            return TranscribeAudioResponse(success=False, error=f"Invalid or inaccessible audio file: {req.audio_key}")
 
         # Start transcription job
-        logger.info(f"Starting transcription job: {transcription_job_name}")
-        transcribe_client.start_transcription_job(
-            TranscriptionJobName=transcription_job_name,
-            Media={'MediaFileUri': f"s3://{req.bucket_name}/{req.audio_key}"},
-            MediaFormat='mp3',
-            LanguageCode=req.language_code,
-            OutputBucketName=req.bucket_name,
-            OutputKey=f"VOD/Subtitles/{asset_id}.json"
+        transcription_job_name = await start_asset_transcription(
+            asset_id, req.bucket_name, req.audio_key, 'mp3', req.language_code
         )
 
         return TranscribeAudioResponse(
@@ -221,22 +392,132 @@ async def transcribe_audio(req: TranscribeAudioRequest) -> TranscribeAudioRespon
             transcription_job_name=transcription_job_name
         )
 
-    except (ClientError, NoCredentialsError, EndpointConnectionError) as e:
-        logger.error(f"AWS Transcribe operation failed: {str(e)}")
+    except ClientError as e:
+        if e.response["Error"]["Code"] in MISSING_S3_ERROR_CODES:
+            logger.error("S3 object - %s/%s does not exist or is inaccessible: %s", req.bucket_name, req.audio_key, e)
+            return TranscribeAudioResponse(success=False, error=f"Invalid or inaccessible audio file: {req.audio_key}")
+        logger.error("AWS Transcribe operation failed: %s", e)
+        return TranscribeAudioResponse(success=False, error=f"AWS Transcribe error: {str(e)}")
+
+    except (NoCredentialsError, EndpointConnectionError) as e:
+        logger.error("AWS Transcribe operation failed: %s", e)
         return TranscribeAudioResponse(success=False, error=f"AWS Transcribe error: {str(e)}")
 
     except ValueError as e:
-        logger.error(f"Validation error: {str(e)}")
+        logger.error("Validation error: %s", e)
         return TranscribeAudioResponse(success=False, error=f"Validation error: {str(e)}")
 
     except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
+        logger.error("Unexpected error: %s", e)
         return TranscribeAudioResponse(success=False, error=f"Unexpected error: {str(e)}")
 
+@app.get("/transcribe-wait/{transcription_job_name}", response_model=TranscriptionStatusResponse)
+async def transcribe_wait(transcription_job_name: str, timeout: float = 300) -> TranscriptionStatusResponse:
+    """Wait up to `timeout` seconds for a Transcribe job to finish and return its latest state."""
+    logger.info("Waiting for transcription job: %s", transcription_job_name)
+    try:
+        if not 0 < timeout <= MAX_WAIT_TIMEOUT:
+            raise ValueError(f"timeout must be greater than 0 and at most {MAX_WAIT_TIMEOUT} seconds, got: {timeout}")
+        job = await wait_for_job(transcription_job_name, timeout=timeout)
+        return TranscriptionStatusResponse(
+            success=True,
+            transcription_job_name=transcription_job_name,
+            status=job["TranscriptionJobStatus"],
+            transcript_uri=job.get("Transcript", {}).get("TranscriptFileUri"),
+            error=job.get("FailureReason")
+        )
+
+    except (ClientError, NoCredentialsError, EndpointConnectionError) as e:
+        logger.error("AWS Transcribe operation failed: %s", e)
+        return TranscriptionStatusResponse(success=False, error=f"AWS Transcribe error: {str(e)}")
+
+    except ValueError as e:
+        logger.error("Validation error: %s", e)
+        return TranscriptionStatusResponse(success=False, error=f"Validation error: {str(e)}")
+
+    except Exception as e:
+        logger.error("Unexpected error: %s", e)
+        return TranscriptionStatusResponse(success=False, error=f"Unexpected error: {str(e)}")
+
+@app.post("/transcribe-callback", response_model=TranscribeCallbackResponse)
+async def transcribe_callback(request: Request) -> TranscribeCallbackResponse:
+    """SNS HTTP(S) subscription endpoint for Transcribe job state change events."""
+    try:
+        message = orjson.loads(await request.body())
+        await verify_sns_message(message)
+        message_type = message.get("Type")
+
+        if message_type == "SubscriptionConfirmation":
+            subscribe_url = urllib.parse.urlparse(message["SubscribeURL"])
+            if subscribe_url.scheme != "https" or not subscribe_url.netloc.endswith(".amazonaws.com"):
+                raise ValueError(f"Refusing to confirm subscription via {subscribe_url.netloc}")
+            response = await asyncio.to_thread(requests.get, message["SubscribeURL"], timeout=10)
+            response.raise_for_status()
+            logger.info("Confirmed SNS subscription for %s", message.get('TopicArn'))
+            return TranscribeCallbackResponse(success=True)
+
+        if message_type != "Notification":
+            raise ValueError(f"Unsupported SNS message type: {message_type}")
+
+        # The notification wraps the EventBridge "Transcribe Job State Change" event
+        detail = orjson.loads(message["Message"])["detail"]
+        update_transcription_job(
+            detail["TranscriptionJobName"],
+            detail["TranscriptionJobStatus"],
+            failure_reason=detail.get("FailureReason")
+        )
+        return TranscribeCallbackResponse(success=True)
+
+    except (KeyError, TypeError, ValueError) as e:
+        logger.error("Invalid transcription callback: %s", e)
+        return TranscribeCallbackResponse(success=False, error=f"Validation error: {str(e)}")
+
+    except Exception as e:
+        logger.error("Unexpected error: %s", e)
+        return TranscribeCallbackResponse(success=False, error=f"Unexpected error: {str(e)}")
+
+async def verify_sns_message(message):
+    """Raise ValueError unless `message` is a correctly signed SNS message from our topic."""
+    if not TRANSCRIBE_CALLBACK_TOPIC_ARN:
+        raise ValueError("TRANSCRIBE_CALLBACK_TOPIC_ARN not set, refusing callbacks")
+    if message.get("TopicArn") != TRANSCRIBE_CALLBACK_TOPIC_ARN:
+        raise ValueError(f"Unexpected SNS topic: {message.get('TopicArn')}")
+    fields = SNS_SIGNED_FIELDS.get(message.get("Type"))
+    if fields is None:
+        raise ValueError(f"Unsupported SNS message type: {message.get('Type')}")
+    if message.get("SignatureVersion") == "1":
+        algorithm = hashes.SHA1()
+    elif message.get("SignatureVersion") == "2":
+        algorithm = hashes.SHA256()
+    else:
+        raise ValueError(f"Unsupported SNS signature version: {message.get('SignatureVersion')}")
+
+    cert_url = message["SigningCertURL"]
+    parsed_cert_url = urllib.parse.urlparse(cert_url)
+    if (parsed_cert_url.scheme != "https"
+            or not SNS_SIGNING_CERT_HOST_RE.match(parsed_cert_url.netloc)
+            or not parsed_cert_url.path.endswith(".pem")):
+        raise ValueError(f"Refusing SNS signing certificate from {cert_url}")
+    certificate = SNS_SIGNING_CERTS.get(cert_url)
+    if certificate is None:
+        response = await asyncio.to_thread(requests.get, cert_url, timeout=10)
+        response.raise_for_status()
+        certificate = SNS_SIGNING_CERTS[cert_url] = x509.load_pem_x509_certificate(response.content)
+
+    string_to_sign = "".join(
+        f"{field}\n{message[field]}\n" for field in fields if message.get(field) is not None
+    )
+    try:
+        certificate.public_key().verify(
+            base64.b64decode(message["Signature"]), string_to_sign.encode(), padding.PKCS1v15(), algorithm
+        )
+    except InvalidSignature:
+        raise ValueError("Invalid SNS message signature")
+
 def get_ecs_credential_metadata():
     base_url = "http://169.254.170.2"
     rel_uri = os.environ.get("AWS_CONTAINER_CREDENTIALS_RELATIVE_URI")
-    logger.info(f"rel_url - {rel_uri}")
+    logger.info("rel_url - %s", rel_uri)
     if rel_uri is None:
         raise EnvironmentError("AWS_CONTAINER_CREDENTIALS_RELATIVE_URI not set.")
 
@@ -244,3 +525,437 @@ def get_ecs_credential_metadata():
     response = requests.get(url)
     response.raise_for_status()
     return response.json()
+
+# Output keys are sharded by the first two hex characters of the asset GUID so
+# writes spread across S3 prefixes instead of all landing under one
+def audio_key_for(asset_id):
+    return f"VOD/FinishedVideos/{asset_id[:2].lower()}/{asset_id}.mp3"
+
+def subtitle_key_for(asset_id):
+    return f"VOD/Subtitles/{asset_id[:2].lower()}/{asset_id}.json"
+
+def parse_s3_location(url):
+    """Return (bucket, key) for an S3-hosted URL, or None for any other URL."""
+    parsed_url = urllib.parse.urlparse(url)
+    if parsed_url.netloc.endswith(f'.s3.{aws_region}.amazonaws.com'):
+        return parsed_url.netloc.split('.')[0], urllib.parse.unquote(parsed_url.path.lstrip('/'))
+    if parsed_url.scheme == 's3':
+        return parsed_url.netloc, parsed_url.path.lstrip('/')
+    return None
+
+def parse_asset_url(url):
+    """Return (bucket, key, asset_id) for an S3-hosted <asset_id>.mp4 URL."""
+    match = S3_ASSET_URL_RE.match(url)
+    if match:
+        return match.group("bucket"), urllib.parse.unquote(match.group("key")), match.group("asset")
+
+    # Extract asset_id from URL (assuming file name is <asset_id>.mp4)
+    parsed_url = urllib.parse.urlparse(url)
+    file_name = os.path.basename(parsed_url.path)
+    # Validate file name format and extract asset_id
+    if not file_name.endswith('.mp4'):
+        raise ValueError(f"Input file must be an .mp4 file, got: {file_name}")
+    asset_id = ASSET_MP4_RE.match(file_name)
+    if not asset_id:
+        raise ValueError(f"File name must be a GUID followed by .mp4, got: {file_name}")
+    asset_id = asset_id.group(1)  # Extract GUID
+
+    # Parse bucket name from URL
+    logger.debug("parsed url - %s", parsed_url)
+    location = parse_s3_location(url)
+    if location is None:
+        raise ValueError("Could not determine bucket name from URL")
+    return location[0], location[1], asset_id
+
+async def probe_cache_key(url):
+    """Cache key for a probe, or None when the result should not be cached.
+
+    S3 objects are keyed on their ETag so a re-upload invalidates the entry.
+    """
+    location = parse_s3_location(url)
+    if location is None:
+        return url
+    bucket_name, key = location
+    try:
+        head = await asyncio.to_thread(s3_client.head_object, Bucket=bucket_name, Key=key)
+    except (ClientError, NoCredentialsError, EndpointConnectionError) as e:
+        logger.warning("Could not read ETag for %s/%s, skipping probe cache: %s", bucket_name, key, e)
+        return None
+    return bucket_name, key, head["ETag"]
+
+def local_cache_path(etag):
+    return os.path.join(LOCAL_CACHE_DIR, etag.strip('"'))
+
+def acquire_local_copy(etag):
+    """Path of the cached copy for an ETag, or None if it isn't cached.
+
+    The copy is marked recently used and kept from eviction until it is passed
+    to release_local_copy.
+    """
+    if LOCAL_CACHE_MAX_BYTES <= 0:
+        return None
+    path = local_cache_path(etag)
+    with LOCAL_CACHE_IN_USE_LOCK:
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        LOCAL_CACHE_IN_USE[path] = LOCAL_CACHE_IN_USE.get(path, 0) + 1
+    return path
+
+def release_local_copy(path):
+    if path is None:
+        return
+    with LOCAL_CACHE_IN_USE_LOCK:
+        LOCAL_CACHE_IN_USE[path] -= 1
+        if not LOCAL_CACHE_IN_USE[path]:
+            del LOCAL_CACHE_IN_USE[path]
+
+async def acquire_s3_local_copy(bucket_name, key):
+    """Acquired local copy of an S3 object (see acquire_local_copy), downloading it on a miss.
+
+    Returns None when the cache is off, the object is bigger than the whole
+    cache, or the copy can't be made, so callers fall back to reading the URL
+    directly. A missing bucket or object is re-raised rather than hidden.
+
+    On a miss the download finishes before ffmpeg starts, so the first
+    extraction of an object doesn't overlap reading with encoding; repeats
+    skip the download entirely.
+    """
+    if LOCAL_CACHE_MAX_BYTES <= 0:
+        return None
+    try:
+        head = await asyncio.to_thread(s3_client.head_object, Bucket=bucket_name, Key=key)
+        path = acquire_local_copy(head["ETag"])
+        if path is not None:
+            logger.debug("Local cache hit for %s/%s", bucket_name, key)
+            return path
+        if head["ContentLength"] > LOCAL_CACHE_MAX_BYTES:
+            logger.info("%s/%s is larger than the local cache, reading it remotely", bucket_name, key)
+            return None
+
+        lock_entry = LOCAL_CACHE_LOCKS.setdefault(local_cache_path(head["ETag"]), [asyncio.Lock(), 0])
+        lock_entry[1] += 1
+        try:
+            async with lock_entry[0]:
+                # Another request may have finished the same download while we waited
+                path = acquire_local_copy(head["ETag"])
+                if path is None:
+                    await asyncio.to_thread(
+                        download_to_local_cache, bucket_name, key, local_cache_path(head["ETag"]), head["ContentLength"]
+                    )
+                    path = acquire_local_copy(head["ETag"])
+        finally:
+            lock_entry[1] -= 1
+            if not lock_entry[1]:
+                LOCAL_CACHE_LOCKS.pop(local_cache_path(head["ETag"]), None)
+
+    except ClientError as e:
+        if e.response["Error"]["Code"] in MISSING_S3_ERROR_CODES:
+            raise
+        logger.warning("Could not cache %s/%s locally, reading it remotely: %s", bucket_name, key, e)
+        return None
+
+    except (NoCredentialsError, EndpointConnectionError, OSError) as e:
+        logger.warning("Could not cache %s/%s locally, reading it remotely: %s", bucket_name, key, e)
+        return None
+
+    return path
+
+def download_to_local_cache(bucket_name, key, path, size):
+    """Download an object into the cache, making room for `size` bytes first."""
+    os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+    partial_path = f"{path}.{uuid.uuid4().hex}.part"
+    with LOCAL_CACHE_IN_USE_LOCK:
+        LOCAL_CACHE_DOWNLOADS[partial_path] = size
+    try:
+        try:
+            evict_local_cache()
+        except OSError as e:
+            logger.warning("Local cache eviction failed: %s", e)
+        s3_client.download_file(bucket_name, key, partial_path, Config=TRANSFER_CONFIG)
+        os.replace(partial_path, path)
+    finally:
+        with LOCAL_CACHE_IN_USE_LOCK:
+            del LOCAL_CACHE_DOWNLOADS[partial_path]
+        try:
+            os.unlink(partial_path)
+        except FileNotFoundError:
+            pass
+
+def evict_local_cache():
+    """Delete least recently used copies not in use until the cache, plus the
+    downloads in progress, fits LOCAL_CACHE_MAX_BYTES. Also removes stale .part files."""
+    entries = []
+    with os.scandir(LOCAL_CACHE_DIR) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if not entry.name.endswith(".part"):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                continue
+            with LOCAL_CACHE_IN_USE_LOCK:
+                if entry.path in LOCAL_CACHE_DOWNLOADS or time.time() - stat.st_mtime < STALE_PART_THRESHOLD:
+                    continue
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+    with LOCAL_CACHE_IN_USE_LOCK:
+        total = sum(size for _, size, _ in entries) + sum(LOCAL_CACHE_DOWNLOADS.values())
+    for _, size, path in sorted(entries):
+        if total <= LOCAL_CACHE_MAX_BYTES:
+            break
+        with LOCAL_CACHE_IN_USE_LOCK:
+            if path in LOCAL_CACHE_IN_USE:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+async def run_command(command):
+    """Run a command without blocking the event loop and return its stdout bytes."""
+    proc = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(
+            proc.returncode, command, output=stdout, stderr=stderr.decode(errors="replace")
+        )
+    return stdout
+
+class SubprocessStdoutReader:
+    """Blocking file-like view of a subprocess's stdout, for boto3 upload_fileobj.
+
+    read() runs on the upload thread and hops onto the event loop for each chunk.
+    Like a regular file it returns exactly `size` bytes unless EOF comes first;
+    s3transfer sizes multipart parts from those reads. At EOF it waits for the
+    process and raises CalledProcessError on a non-zero exit, so a failed encode
+    aborts the upload instead of storing a partial file.
+    """
+
+    def __init__(self, proc, command, stderr_task, loop):
+        self.proc = proc
+        self.command = command
+        self.stderr_task = stderr_task
+        self.loop = loop
+
+    def read(self, size=-1):
+        return asyncio.run_coroutine_threadsafe(self._read(size), self.loop).result()
+
+    async def _read(self, size):
+        if size is None or size < 0:
+            data = await self.proc.stdout.read()
+        else:
+            try:
+                return await self.proc.stdout.readexactly(size)
+            except asyncio.IncompleteReadError as e:
+                data = e.partial
+        await self.check_exit()
+        return data
+
+    async def check_exit(self):
+        stderr = await self.stderr_task
+        if await self.proc.wait() != 0:
+            raise subprocess.CalledProcessError(
+                self.proc.returncode, self.command, stderr=stderr.decode(errors="replace")
+            )
+
+async def stream_command_to_s3(command, bucket_name, key, extra_args):
+    """Run a command and upload its stdout to S3 while it is still being produced."""
+    proc = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stderr_task = asyncio.create_task(proc.stderr.read())
+    try:
+        reader = SubprocessStdoutReader(proc, command, stderr_task, asyncio.get_running_loop())
+        await asyncio.to_thread(
+            s3_client.upload_fileobj,
+            reader,
+            bucket_name,
+            key,
+            ExtraArgs=extra_args,
+            Config=TRANSFER_CONFIG
+        )
+        # The upload finished, but only a clean exit means the object is complete
+        try:
+            await reader.check_exit()
+        except subprocess.CalledProcessError:
+            await asyncio.to_thread(s3_client.delete_object, Bucket=bucket_name, Key=key)
+            raise
+    finally:
+        # The upload may have failed while the command was still writing
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+
+async def start_asset_transcription(asset_id, bucket_name, media_key, media_format, language_code, existing_ok=False):
+    """Start the Transcribe job for an asset and return its job name.
+
+    With `existing_ok`, a job of the same name that is already there (e.g.
+    started by an earlier delivery of a queued job) is tracked and returned.
+    """
+    transcription_job_name = f"transcription_{asset_id}"
+    logger.info("Starting transcription job: %s", transcription_job_name)
+    try:
+        await submit_transcription_job(
+            TranscriptionJobName=transcription_job_name,
+            Media={'MediaFileUri': f"s3://{bucket_name}/{media_key}"},
+            MediaFormat=media_format,
+            LanguageCode=language_code,
+            OutputBucketName=bucket_name,
+            OutputKey=subtitle_key_for(asset_id)
+        )
+    except ClientError as e:
+        if not existing_ok or e.response["Error"]["Code"] != "ConflictException":
+            raise
+        logger.info("Transcription job %s already exists", transcription_job_name)
+        if transcription_job_name in TRANSCRIPTION_JOBS:
+            return transcription_job_name
+    TRANSCRIPTION_JOBS[transcription_job_name] = {
+        "status": "IN_PROGRESS",
+        "submitted_at": time.time(),
+        # Where Transcribe will write the result; the state change event doesn't carry it
+        "transcript_uri": f"https://s3.{aws_region}.amazonaws.com/{bucket_name}/{subtitle_key_for(asset_id)}",
+        "failure_reason": None
+    }
+    return transcription_job_name
+
+def is_retryable_error(e):
+    """Whether an AWS error is likely transient: throttling, a 5xx, or no connection."""
+    if isinstance(e, (NoCredentialsError, EndpointConnectionError)):
+        return True
+    if isinstance(e, ClientError):
+        return (e.response["Error"]["Code"] in RETRYABLE_ERROR_CODES
+                or e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500)
+    return False
+
+async def submit_transcription_job(**params):
+    """Call start_transcription_job off the event loop, bounded by TRANSCRIPTION_SUBMIT_SEMAPHORE."""
+    async with TRANSCRIPTION_SUBMIT_SEMAPHORE:
+        return await asyncio.to_thread(transcribe_client.start_transcription_job, **params)
+
+def update_transcription_job(transcription_job_name, status, transcript_uri=None, failure_reason=None):
+    job = TRANSCRIPTION_JOBS.get(transcription_job_name)
+    if job is None:
+        job = TRANSCRIPTION_JOBS[transcription_job_name] = {
+            "status": status, "submitted_at": time.time(), "transcript_uri": None, "failure_reason": None
+        }
+    job["status"] = status
+    if transcript_uri is not None:
+        job["transcript_uri"] = transcript_uri
+    if failure_reason is not None:
+        job["failure_reason"] = failure_reason
+    if status in TERMINAL_JOB_STATUSES:
+        logger.info("Transcription job %s finished with status %s", transcription_job_name, status)
+
+def list_active_transcription_job_names():
+    """Names of all queued or in-progress Transcribe jobs in the account."""
+    names = set()
+    for status in ("QUEUED", "IN_PROGRESS"):
+        params = {"Status": status, "MaxResults": 100}
+        while True:
+            page = transcribe_client.list_transcription_jobs(**params)
+            names.update(job["TranscriptionJobName"] for job in page.get("TranscriptionJobSummaries", []))
+            if not page.get("NextToken"):
+                break
+            params["NextToken"] = page["NextToken"]
+    return names
+
+async def reconcile_transcription_jobs():
+    """Resolve tracked jobs that finished without a callback and flag stale ones."""
+    pending = {
+        name: job for name, job in TRANSCRIPTION_JOBS.items()
+        if job["status"] not in TERMINAL_JOB_STATUSES
+    }
+    if not pending:
+        return
+    active = await asyncio.to_thread(list_active_transcription_job_names)
+    now = time.time()
+    for name, job in pending.items():
+        if name in active:
+            if now - job["submitted_at"] > STALE_JOB_THRESHOLD:
+                logger.warning("Transcription job %s still running after %ds", name, int(now - job['submitted_at']))
+            continue
+        try:
+            result = await asyncio.to_thread(transcribe_client.get_transcription_job, TranscriptionJobName=name)
+        except ClientError as e:
+            # BadRequestException is how Transcribe reports an unknown job; anything
+            # else (throttling, limits) is transient, so try again next sweep
+            if e.response["Error"]["Code"] != "BadRequestException":
+                logger.warning("Could not look up transcription job %s, retrying next sweep: %s", name, e)
+                continue
+            logger.error("Transcription job %s not found, no longer tracking it: %s", name, e)
+            TRANSCRIPTION_JOBS.pop(name, None)
+            continue
+        update_transcription_job_from_description(result["TranscriptionJob"])
+
+def update_transcription_job_from_description(job):
+    update_transcription_job(
+        job["TranscriptionJobName"],
+        job["TranscriptionJobStatus"],
+        transcript_uri=job.get("Transcript", {}).get("TranscriptFileUri"),
+        failure_reason=job.get("FailureReason")
+    )
+
+def finished_job_from_registry(transcription_job_name):
+    """A TranscriptionJob-shaped description of a job the registry already knows has finished, or None."""
+    job = TRANSCRIPTION_JOBS.get(transcription_job_name)
+    if job is None or job["status"] not in TERMINAL_JOB_STATUSES:
+        return None
+    if job["status"] == "COMPLETED" and job["transcript_uri"] is None:
+        return None
+    description = {"TranscriptionJobName": transcription_job_name, "TranscriptionJobStatus": job["status"]}
+    if job["transcript_uri"] is not None:
+        description["Transcript"] = {"TranscriptFileUri": job["transcript_uri"]}
+    if job["failure_reason"] is not None:
+        description["FailureReason"] = job["failure_reason"]
+    return description
+
+async def poll_transcription_jobs():
+    while True:
+        await asyncio.sleep(POLLING_INTERVAL)
+        try:
+            await reconcile_transcription_jobs()
+        except Exception as e:
+            logger.error("Transcription job sweep failed: %s", e)
+
+async def wait_for_job(transcription_job_name, base=2.0, cap=60.0, timeout=None):
+    """Poll a Transcribe job until it finishes, backing off exponentially with jitter.
+
+    Returns the TranscriptionJob description: the terminal one, or the latest
+    seen when `timeout` seconds pass first. Once the registry knows the job has
+    finished (from /transcribe-callback or the sweep), no describe call is made.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    attempt = 0
+    while True:
+        job = finished_job_from_registry(transcription_job_name)
+        if job is not None:
+            return job
+        result = await asyncio.to_thread(
+            transcribe_client.get_transcription_job, TranscriptionJobName=transcription_job_name
+        )
+        job = result["TranscriptionJob"]
+        if job["TranscriptionJobStatus"] in TERMINAL_JOB_STATUSES:
+            update_transcription_job_from_description(job)
+            return job
+
+        # The exponent stops growing once the delay is capped, so it can't overflow
+        delay = min(cap, base * 2 ** min(attempt, 32)) + random.uniform(0, 1)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return job
+            delay = min(delay, remaining)
+        await asyncio.sleep(delay)
+        attempt += 1
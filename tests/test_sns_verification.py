@@ -0,0 +1,101 @@
+import asyncio
+import base64
+import datetime
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import NameOID
+
+import main
+
+CERT_URL = "https://sns.us-west-2.amazonaws.com/SimpleNotificationService-test.pem"
+TOPIC_ARN = "arn:aws:sns:us-west-2:123456789012:transcribe-job-events"
+
+
+@pytest.fixture
+def signing_key(monkeypatch):
+    """A throwaway RSA key whose certificate stands in for the SNS signing cert."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "sns.amazonaws.com")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(1)
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    monkeypatch.setattr(main, "TRANSCRIBE_CALLBACK_TOPIC_ARN", TOPIC_ARN)
+    monkeypatch.setattr(main, "SNS_SIGNING_CERTS", {CERT_URL: certificate})
+    return key
+
+
+def signed_notification(key, signature_version):
+    message = {
+        "Type": "Notification",
+        "MessageId": "22b80b92-fdea-4c2c-8f9d-bdfb0c7bf324",
+        "TopicArn": TOPIC_ARN,
+        "Subject": "Transcribe Job State Change",
+        "Message": '{"detail": {"TranscriptionJobName": "transcription_x", "TranscriptionJobStatus": "COMPLETED"}}',
+        "Timestamp": "2026-10-15T12:00:00.000Z",
+        "SignatureVersion": signature_version,
+        "SigningCertURL": CERT_URL,
+    }
+    # The string to sign as documented for SNS notifications
+    string_to_sign = (
+        f"Message\n{message['Message']}\n"
+        f"MessageId\n{message['MessageId']}\n"
+        f"Subject\n{message['Subject']}\n"
+        f"Timestamp\n{message['Timestamp']}\n"
+        f"TopicArn\n{message['TopicArn']}\n"
+        f"Type\n{message['Type']}\n"
+    )
+    algorithm = hashes.SHA1() if signature_version == "1" else hashes.SHA256()
+    signature = key.sign(string_to_sign.encode(), padding.PKCS1v15(), algorithm)
+    message["Signature"] = base64.b64encode(signature).decode()
+    return message
+
+
+@pytest.mark.parametrize("signature_version", ["1", "2"])
+def test_valid_signature_is_accepted(signing_key, signature_version):
+    asyncio.run(main.verify_sns_message(signed_notification(signing_key, signature_version)))
+
+
+@pytest.mark.parametrize("signature_version", ["1", "2"])
+def test_tampered_message_is_rejected(signing_key, signature_version):
+    message = signed_notification(signing_key, signature_version)
+    message["Message"] = message["Message"].replace("COMPLETED", "FAILED")
+    with pytest.raises(ValueError, match="Invalid SNS message signature"):
+        asyncio.run(main.verify_sns_message(message))
+
+
+def test_signature_version_must_match_hash(signing_key):
+    message = signed_notification(signing_key, "2")
+    message["SignatureVersion"] = "1"
+    with pytest.raises(ValueError, match="Invalid SNS message signature"):
+        asyncio.run(main.verify_sns_message(message))
+
+
+def test_other_topic_is_rejected(signing_key):
+    message = signed_notification(signing_key, "2")
+    message["TopicArn"] = "arn:aws:sns:us-west-2:123456789012:someone-else"
+    with pytest.raises(ValueError, match="Unexpected SNS topic"):
+        asyncio.run(main.verify_sns_message(message))
+
+
+def test_non_sns_certificate_url_is_rejected(signing_key):
+    message = signed_notification(signing_key, "2")
+    message["SigningCertURL"] = "https://example.com/SimpleNotificationService-test.pem"
+    with pytest.raises(ValueError, match="Refusing SNS signing certificate"):
+        asyncio.run(main.verify_sns_message(message))
+
+
+def test_callbacks_refused_without_configured_topic(signing_key, monkeypatch):
+    monkeypatch.setattr(main, "TRANSCRIBE_CALLBACK_TOPIC_ARN", None)
+    with pytest.raises(ValueError, match="TRANSCRIBE_CALLBACK_TOPIC_ARN not set"):
+        asyncio.run(main.verify_sns_message(signed_notification(signing_key, "2")))
@@ -0,0 +1,81 @@
+import asyncio
+import subprocess
+import sys
+
+import pytest
+
+import main
+
+CHUNK_SIZE = 1024 * 1024
+
+# Writes `total` bytes in small flushed pieces so the pipe delivers them in
+# many short bursts, then exits with `code`
+WRITER = """
+import sys
+total, code = int(sys.argv[1]), int(sys.argv[2])
+piece = b"x" * 65536
+while total > 0:
+    n = min(total, len(piece))
+    sys.stdout.buffer.write(piece[:n])
+    sys.stdout.buffer.flush()
+    total -= n
+sys.exit(code)
+"""
+
+
+def writer_command(total, code=0):
+    return [sys.executable, "-c", WRITER, str(total), str(code)]
+
+
+class FakeS3:
+    """Reads the stream the way s3transfer does: fixed-size reads until EOF."""
+
+    def __init__(self, max_reads=None):
+        self.max_reads = max_reads
+        self.uploads = {}
+        self.deleted = []
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Config=None):
+        chunks = []
+        while self.max_reads is None or len(chunks) < self.max_reads:
+            chunk = fileobj.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.uploads[(bucket, key)] = chunks
+
+    def delete_object(self, Bucket, Key):
+        self.deleted.append((Bucket, Key))
+
+
+def test_reads_are_full_until_eof(monkeypatch):
+    fake_s3 = FakeS3()
+    monkeypatch.setattr(main, "s3_client", fake_s3)
+    total = 3 * CHUNK_SIZE + 12345
+
+    asyncio.run(main.stream_command_to_s3(writer_command(total), "bucket", "key.mp3", {}))
+
+    chunks = fake_s3.uploads[("bucket", "key.mp3")]
+    assert [len(chunk) for chunk in chunks] == [CHUNK_SIZE] * 3 + [12345]
+    assert fake_s3.deleted == []
+
+
+def test_failed_command_aborts_upload(monkeypatch):
+    fake_s3 = FakeS3()
+    monkeypatch.setattr(main, "s3_client", fake_s3)
+
+    with pytest.raises(subprocess.CalledProcessError):
+        asyncio.run(main.stream_command_to_s3(writer_command(CHUNK_SIZE // 2, code=1), "bucket", "key.mp3", {}))
+
+    assert fake_s3.uploads == {}
+
+
+def test_failure_after_upload_deletes_object(monkeypatch):
+    # The upload stops reading before EOF, so the exit status is only seen afterwards
+    fake_s3 = FakeS3(max_reads=1)
+    monkeypatch.setattr(main, "s3_client", fake_s3)
+
+    with pytest.raises(subprocess.CalledProcessError):
+        asyncio.run(main.stream_command_to_s3(writer_command(CHUNK_SIZE, code=1), "bucket", "key.mp3", {}))
+
+    assert fake_s3.deleted == [("bucket", "key.mp3")]
@@ -0,0 +1,113 @@
+import asyncio
+
+import orjson
+from botocore.exceptions import ClientError, NoCredentialsError, EndpointConnectionError
+
+from main import (
+    EXTRACT_COMPLETION_TOPIC_ARN,
+    EXTRACT_QUEUE_URL,
+    FFMPEG_CONCURRENCY,
+    ExtractAudioRequest,
+    app,
+    is_retryable_error,
+    lifespan,
+    logger,
+    parse_asset_url,
+    run_extract_audio,
+    sns_client,
+    sqs_client,
+    start_asset_transcription,
+)
+
+# SQS redelivers a message if this runs out, so running jobs extend it every
+# VISIBILITY_HEARTBEAT seconds
+VISIBILITY_TIMEOUT = 900
+VISIBILITY_HEARTBEAT = VISIBILITY_TIMEOUT // 3
+# Jobs run at once; one per encode slot, so a received message never sits
+# waiting on FFMPEG_SEMAPHORE while its visibility timeout runs
+WORKER_CONCURRENCY = FFMPEG_CONCURRENCY
+
+async def handle_message(message):
+    body = orjson.loads(message["Body"])
+    job_id = body["job_id"]
+    req = ExtractAudioRequest(**body["request"])
+    logger.info("Running queued extraction job %s", job_id)
+
+    # Transient failures raise, leaving the message for redelivery
+    result = await run_extract_audio(req, queued=True)
+
+    # Run the whole pipeline so callers don't have to follow up with /transcribe-audio.
+    # transcribe_directly already started the job from the MP4.
+    if result.success and result.output_key and not result.transcription_job_name:
+        bucket_name, _, asset_id = parse_asset_url(req.url)
+        try:
+            result.transcription_job_name = await start_asset_transcription(
+                asset_id, bucket_name, result.output_key, 'mp3', req.language_code, existing_ok=True
+            )
+        except (ClientError, NoCredentialsError, EndpointConnectionError) as e:
+            if is_retryable_error(e):
+                raise
+            logger.error("AWS Transcribe operation failed for job %s: %s", job_id, e)
+            result.success = False
+            result.error = f"AWS Transcribe error: {str(e)}"
+
+    if EXTRACT_COMPLETION_TOPIC_ARN:
+        await asyncio.to_thread(
+            sns_client.publish,
+            TopicArn=EXTRACT_COMPLETION_TOPIC_ARN,
+            Message=orjson.dumps({**result.model_dump(), "job_id": job_id, "url": req.url}).decode()
+        )
+    # Only acknowledge once the result is out; failures above leave the message for redelivery
+    await asyncio.to_thread(
+        sqs_client.delete_message, QueueUrl=EXTRACT_QUEUE_URL, ReceiptHandle=message["ReceiptHandle"]
+    )
+
+async def extend_visibility(message):
+    """Keep a message hidden from other consumers for as long as its job runs."""
+    while True:
+        await asyncio.sleep(VISIBILITY_HEARTBEAT)
+        try:
+            await asyncio.to_thread(
+                sqs_client.change_message_visibility,
+                QueueUrl=EXTRACT_QUEUE_URL,
+                ReceiptHandle=message["ReceiptHandle"],
+                VisibilityTimeout=VISIBILITY_TIMEOUT
+            )
+        except (ClientError, NoCredentialsError, EndpointConnectionError) as e:
+            logger.warning("Could not extend visibility of message %s: %s", message["MessageId"], e)
+
+async def safe_handle_message(message):
+    heartbeat = asyncio.create_task(extend_visibility(message))
+    try:
+        await handle_message(message)
+    except Exception as e:
+        logger.error("Queued extraction job failed, leaving it for redelivery: %s", e)
+    finally:
+        heartbeat.cancel()
+
+async def consume():
+    """Long-poll the extraction queue, taking only as many jobs as there are free slots."""
+    running = set()
+    # Same background tasks as the API, e.g. the transcription job sweep
+    async with lifespan(app):
+        while True:
+            free_slots = WORKER_CONCURRENCY - len(running)
+            if not free_slots:
+                await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            response = await asyncio.to_thread(
+                sqs_client.receive_message,
+                QueueUrl=EXTRACT_QUEUE_URL,
+                MaxNumberOfMessages=min(free_slots, 10),
+                WaitTimeSeconds=20,
+                VisibilityTimeout=VISIBILITY_TIMEOUT
+            )
+            for message in response.get("Messages", []):
+                task = asyncio.create_task(safe_handle_message(message))
+                running.add(task)
+                task.add_done_callback(running.discard)
+
+if __name__ == "__main__":
+    if not EXTRACT_QUEUE_URL:
+        raise EnvironmentError("EXTRACT_QUEUE_URL not set.")
+    asyncio.run(consume())